@@ -1,51 +1,217 @@
+import hashlib
+import numbers
 import os
+import queue
 import re
-import openai
-import psycopg2
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict, namedtuple
+import httpx
+import numpy as np
+import psycopg
+from psycopg.conninfo import make_conninfo
+from psycopg.sql import SQL, Identifier
+from psycopg_pool import ConnectionPool
+from openai import OpenAI
 import speech_recognition as sr
 import pyttsx3
+import sqlparse
+from sqlparse.sql import Comparison, Function, Identifier as SqlIdentifier, IdentifierList, Parenthesis, Where
+from sqlparse.tokens import Keyword, Operator, String
+from faster_whisper import WhisperModel
 from datetime import datetime
-from tabulate import tabulate
 from dotenv import load_dotenv
 
 load_dotenv()
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
-openai.api_base = os.getenv("OPENAI_API_BASE") or "https://api.openai.com/v1"  
+OPENAI_MODEL = "gpt-4o-mini"
+
+client = OpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    base_url=os.getenv("OPENAI_API_BASE") or "https://api.openai.com/v1",
+    http_client=httpx.Client(http2=True, limits=httpx.Limits(max_keepalive_connections=4))
+)
 
 DB_CONFIG = {
     "host": os.getenv("DB_HOST"),
     "port": os.getenv("DB_PORT"),
     "user": os.getenv("DB_USER"),
     "password": os.getenv("DB_PASSWORD"),
-    "database": os.getenv("DB_NAME")
+    "dbname": os.getenv("DB_NAME")
 }
 
-engine = pyttsx3.init()
-engine.setProperty('rate', 150)
+PREPARE_THRESHOLD = 3
+POOL_TIMEOUT = 10
+SCHEMA_CACHE_TTL = 300
+OPERATIONS = {"select", "insert", "update", "delete", "create", "drop", "alter", "truncate"}
+DDL_OPERATIONS = {"create", "drop", "alter", "truncate"}
+MAX_DISPLAY = 100
+ROW_LIMIT = 1000
+MAX_QUERY_COST = float(os.getenv("MAX_QUERY_COST") or 1e7)
+COPY_THRESHOLD = 1000
+RECALIBRATE_AFTER = 2
+TEXT_TYPES = {"character varying", "text"}
+SEARCH_STOPWORDS = {
+    "a", "all", "an", "and", "any", "are", "by", "called", "display", "does", "find", "for",
+    "from", "get", "give", "has", "have", "i", "in", "is", "list", "me", "named", "of", "on",
+    "or", "please", "records", "rows", "search", "show", "tell", "the", "to", "what", "where",
+    "which", "who", "whose", "with"
+}
+
+SqlInfo = namedtuple("SqlInfo", ["operation", "table", "filters", "has_limit"])
+
+_schema_cache = {}
+_fts_indexed = set()
+
+_SQL_FENCE = re.compile(r"```sql|```")
+_FENCED_BLOCK = re.compile(r"```(?:sql)?\s.*?```", re.DOTALL)
+_BARE_EQ = re.compile(r"=\s*([a-zA-Z_][a-zA-Z0-9_]*)")
+_WHERE_EQ = re.compile(r"WHERE\s+(\w+)\s*=\s*'([^']+)'", re.IGNORECASE)
+PRONOUNS = ("he", "she", "they", "it", "that")
+_PRONOUNS = re.compile(r"\b(?:" + "|".join(map(re.escape, PRONOUNS)) + r")\b", re.IGNORECASE)
+_WORD = re.compile(r"\w+")
+_INSERT_VALUES = re.compile(
+    r"^\s*INSERT\s+INTO\s+(\w+)\s*\(([^)]*)\)\s*VALUES\s*(.*?)\s*;?\s*$",
+    re.IGNORECASE | re.DOTALL
+)
+# Quoted strings and NULL only: unquoted numbers and booleans get assignment
+# casts under INSERT, which COPY's input functions would not reproduce.
+_VALUE_LITERAL = re.compile(r"\s*(?:'((?:[^']|'')*)'|(NULL)\b)\s*([,)])", re.IGNORECASE)
+_ROW_START = re.compile(r"\s*\(")
+_ROW_SEPARATOR = re.compile(r"\s*,")
+
+admin_pool = ConnectionPool(
+    make_conninfo(**{**DB_CONFIG, "dbname": "postgres"}),
+    min_size=1,
+    max_size=1,
+    kwargs={"autocommit": True},
+    open=False
+)
+
+def open_pool(dbname):
+    pool = ConnectionPool(
+        make_conninfo(**{**DB_CONFIG, "dbname": dbname}),
+        min_size=1,
+        max_size=4,
+        kwargs={"autocommit": False, "prepare_threshold": PREPARE_THRESHOLD},
+        open=False
+    )
+    try:
+        pool.open(wait=True, timeout=POOL_TIMEOUT)
+    except Exception:
+        pool.close()
+        raise
+    return pool
+
+recognizer = sr.Recognizer()
+recognizer.pause_threshold = 0.5
+recognizer.non_speaking_duration = 0.3
+whisper_model = WhisperModel(
+    os.getenv("WHISPER_MODEL") or "small.en",
+    device="cpu",
+    compute_type="int8"
+)
+
+LOG_FH = open("query_log.txt", "a", buffering=1)
+log_queue = queue.Queue()
+
+def _log_writer():
+    while True:
+        record = log_queue.get()
+        try:
+            LOG_FH.write(record)
+        except Exception as e:
+            print(f"Log error: {e}")
+        finally:
+            log_queue.task_done()
+
+threading.Thread(target=_log_writer, daemon=True).start()
+
+# pyttsx3's macOS driver needs the main thread's run loop, so speak inline there.
+TTS_INLINE = sys.platform == "darwin"
+tts_queue = queue.Queue()
+
+def init_tts():
+    try:
+        engine = pyttsx3.init()
+        engine.setProperty('rate', 150)
+        return engine
+    except Exception as e:
+        print(f"TTS unavailable: {e}")
+        return None
+
+def say(engine, text):
+    if engine is None:
+        return
+    try:
+        engine.say(text)
+        engine.runAndWait()
+    except Exception as e:
+        print(f"TTS error: {e}")
+
+def _tts_worker():
+    engine = init_tts()
+    while True:
+        text = tts_queue.get()
+        try:
+            say(engine, text)
+        finally:
+            tts_queue.task_done()
+
+if TTS_INLINE:
+    inline_engine = init_tts()
+else:
+    threading.Thread(target=_tts_worker, daemon=True).start()
 
 def speak(text):
     print(f"Assistant: {text}")
-    engine.say(text)
-    engine.runAndWait()
+    if TTS_INLINE:
+        say(inline_engine, text)
+    else:
+        tts_queue.put(text)
+
+def calibrate_microphone():
+    # Don't sample the room while the assistant is talking.
+    tts_queue.join()
+    with sr.Microphone() as source:
+        recognizer.adjust_for_ambient_noise(source)
+
+def transcribe(audio):
+    pcm = np.frombuffer(audio.get_raw_data(convert_rate=16000, convert_width=2), dtype=np.int16)
+    segments, _ = whisper_model.transcribe(
+        pcm.astype(np.float32) / 32768.0,
+        beam_size=1,
+        vad_filter=True
+    )
+    text = " ".join(segment.text for segment in segments).strip(" .!?,")
+    if not text:
+        raise sr.UnknownValueError()
+    return text
 
 def get_voice_command(prompt=None, retries=3):
-    r = sr.Recognizer()
     attempt = 0
+    misses = 0
     while attempt < retries:
+        if prompt:
+            speak(prompt)
+        # Don't open the mic while the assistant is talking, or it hears itself.
+        tts_queue.join()
         with sr.Microphone() as source:
-            if prompt:
-                speak(prompt)
+            if misses >= RECALIBRATE_AFTER:
+                recognizer.adjust_for_ambient_noise(source)
+                misses = 0
             print("\nListening... (Say 'exit' to quit)")
-            r.adjust_for_ambient_noise(source)
             try:
-                audio = r.listen(source, timeout=5)
-                command = r.recognize_google(audio).lower()
+                audio = recognizer.listen(source, timeout=5)
+                command = transcribe(audio).lower()
                 print(f"You said: {command}")
                 return command
             except sr.UnknownValueError:
                 speak("Sorry, I didn't catch that. Please try again.")
                 attempt += 1
+                misses += 1
             except sr.WaitTimeoutError:
                 speak("Listening timed out. Please try again.")
                 attempt += 1
@@ -53,7 +219,37 @@ def get_voice_command(prompt=None, retries=3):
     return ""
 
 def clean_sql(sql):
-    return re.sub(r"```sql|```", "", sql).strip()
+    return _SQL_FENCE.sub("", sql).strip()
+
+def warm_up_openai():
+    try:
+        client.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=[{"role": "user", "content": "ping"}],
+            max_tokens=1
+        )
+    except Exception:
+        pass
+
+def request_sql_completion(messages):
+    stream = client.chat.completions.create(
+        model=OPENAI_MODEL,
+        messages=messages,
+        temperature=0.1,
+        stream=True
+    )
+    text = ""
+    try:
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                text += chunk.choices[0].delta.content
+                # Anything after the closing fence is prose; stop paying for it.
+                fenced = _FENCED_BLOCK.search(text)
+                if fenced:
+                    return text[:fenced.end()]
+    finally:
+        stream.close()
+    return text
 
 def generate_sql_with_openai(command, schema_info):
     try:
@@ -68,100 +264,305 @@ def generate_sql_with_openai(command, schema_info):
             },
             {"role": "user", "content": command}
         ]
-        response = openai.ChatCompletion.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            temperature=0.1
-        )
-        sql = response["choices"][0]["message"]["content"].strip()
-        return clean_sql(sql)
+        return clean_sql(request_sql_completion(messages))
     except Exception as e:
         speak(f"OpenAI error: {str(e)}")
         return None
 
 def self_heal_sql(sql):
-    return re.sub(r"=\s*([a-zA-Z_][a-zA-Z0-9_]*)", r"= '\1'", sql)
+    return _BARE_EQ.sub(r"= '\1'", sql)
 
 def auto_lowercase_where(sql):
-    return re.sub(
-        r"WHERE\s+(\w+)\s*=\s*'([^']+)'",
+    return _WHERE_EQ.sub(
         lambda m: f"WHERE LOWER({m.group(1)}) = LOWER('{m.group(2)}')",
-        sql,
-        flags=re.IGNORECASE
+        sql
     )
 
-def detect_operation(sql):
-    first = sql.strip().lower().split()[0]
-    if "create database" in sql.lower():
-        return "create_db"
-    elif "drop database" in sql.lower():
-        return "drop_db"
-    elif first in ["select", "insert", "update", "delete", "create", "drop", "alter", "truncate"]:
-        return first
-    return "other"
-
-def detected_table_name(sql):
-    match = re.search(r"from\s+(\w+)", sql.lower())
-    return match.group(1) if match else None
-
-def extract_filters(sql):
+def unwrap_lower(token):
+    if isinstance(token, Function) and token.get_name().lower() == "lower":
+        params = token.get_parameters()
+        return params[0] if len(params) == 1 else None
+    return token
+
+def collect_filters(token, filters):
+    for sublist in token.get_sublists():
+        if isinstance(sublist, Comparison):
+            # Only equalities name the subject; <>, LIKE and friends do not.
+            operator = next((t for t in sublist.tokens if t.ttype in Operator.Comparison), None)
+            if operator is None or operator.value != "=":
+                continue
+            column = unwrap_lower(sublist.left)
+            value = unwrap_lower(sublist.right)
+            if isinstance(column, SqlIdentifier) and value is not None and value.ttype in String:
+                filters[column.get_real_name().lower()] = value.value[1:-1].replace("''", "'").lower()
+        else:
+            collect_filters(sublist, filters)
+
+def analyze_sql(sql):
+    statements = sqlparse.parse(sql)
+    first = statements[0].token_first(skip_cm=True) if statements else None
+    if first is None:
+        return SqlInfo("other", None, {}, False)
+    statement = statements[0]
+
+    operation = first.normalized.lower()
+    if operation in ("create", "drop"):
+        _, target = statement.token_next(statement.token_index(first))
+        if target is not None and target.normalized == "DATABASE":
+            operation += "_db"
+    elif operation not in OPERATIONS:
+        operation = "other"
+
+    table = None
     filters = {}
-    matches = re.findall(r"lower\((\w+)\)\s*=\s*lower\('([^']+)'\)", sql.lower())
-    for col, val in matches:
-        filters[col] = val
-    return filters
+    has_limit = False
+    after_from = False
+    for token in statement.tokens:
+        if token.is_whitespace:
+            continue
+        if after_from and table is None:
+            if isinstance(token, IdentifierList):
+                token = next(iter(token.get_identifiers()), None)
+            if isinstance(token, SqlIdentifier):
+                subquery = next((t for t in token.tokens if isinstance(t, Parenthesis)), None)
+                if subquery is not None:
+                    # The alias of a derived table is not a table; use the one inside it.
+                    table = analyze_sql(str(subquery)[1:-1]).table
+                else:
+                    table = token.get_real_name().lower()
+        if isinstance(token, Where):
+            collect_filters(token, filters)
+        if token.ttype in Keyword and token.normalized == "LIMIT":
+            has_limit = True
+        after_from = token.ttype in Keyword and token.normalized == "FROM"
+    return SqlInfo(operation, table, filters, has_limit)
+
+def resolve_pronouns(command, last_filters):
+    if not last_filters:
+        return command
+    replacements = dict.fromkeys(PRONOUNS, next(iter(last_filters.values())))
+    return _PRONOUNS.sub(lambda m: replacements[m.group(0).lower()], command)
+
+def parse_bulk_insert(sql):
+    match = _INSERT_VALUES.match(sql)
+    if not match:
+        return None
+    table, column_list, values = match.groups()
+    columns = [col.strip().lower() for col in column_list.split(",")]
+    if not all(col.isidentifier() for col in columns):
+        return None
+
+    rows = []
+    pos = 0
+    while pos < len(values):
+        if rows:
+            separator = _ROW_SEPARATOR.match(values, pos)
+            if not separator:
+                return None
+            pos = separator.end()
+        start = _ROW_START.match(values, pos)
+        if not start:
+            return None
+        pos = start.end()
+        row = []
+        while True:
+            literal = _VALUE_LITERAL.match(values, pos)
+            if not literal:
+                return None
+            text, null, end = literal.groups()
+            row.append(None if null else text.replace("''", "'"))
+            pos = literal.end()
+            if end == ")":
+                break
+        if len(row) != len(columns):
+            return None
+        rows.append(row)
+    return table.lower(), columns, rows
+
+def copy_rows(cursor, table, columns, rows):
+    statement = SQL("COPY {} ({}) FROM STDIN").format(
+        Identifier(table),
+        SQL(", ").join(map(Identifier, columns))
+    )
+    with cursor.copy(statement) as copy:
+        for row in rows:
+            copy.write_row(row)
+
+def load_schema(conn):
+    cached = _schema_cache.get(conn.info.dbname)
+    if cached and time.monotonic() - cached[0] < SCHEMA_CACHE_TTL:
+        return cached
+
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT table_name, column_name, data_type 
+            FROM information_schema.columns 
+            WHERE table_schema = 'public'
+        """)
+        schema = defaultdict(list)
+        for table, column, dtype in cursor.stream():
+            schema[table].append((column, dtype))
+    schema = dict(schema)
+    schema_info = "\n".join(
+        f"{table}: " + ", ".join(f"{column} ({dtype})" for column, dtype in cols)
+        for table, cols in schema.items()
+    )
+    cached = (time.monotonic(), schema_info, schema)
+    _schema_cache[conn.info.dbname] = cached
+    return cached
+
+def invalidate_schema(dbname):
+    _schema_cache.pop(dbname, None)
+    _fts_indexed.difference_update({key for key in _fts_indexed if key[0] == dbname})
+
+def get_table_columns(conn, table):
+    columns = load_schema(conn)[2].get(table)
+    if columns is not None:
+        return columns
+
+    # Not in the cached schema; another session may have created it since.
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT column_name, data_type
+            FROM information_schema.columns
+            WHERE table_schema = 'public' AND table_name = %s
+        """, (table,))
+        columns = cursor.fetchall()
+    if not columns:
+        return None
+    invalidate_schema(conn.info.dbname)
+    return columns
 
 def get_schema_info(conn):
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("""
-                SELECT table_name, column_name, data_type 
-                FROM information_schema.columns 
-                WHERE table_schema = 'public'
-            """)
-            schema = {}
-            for table, column, dtype in cursor.fetchall():
-                if table not in schema:
-                    schema[table] = []
-                schema[table].append(f"{column} ({dtype})")
-            return "\n".join([f"{table}: " + ", ".join(cols) for table, cols in schema.items()])
-    except psycopg2.Error as e:
+        return load_schema(conn)[1]
+    except psycopg.Error as e:
         return f"Schema retrieval error: {e}"
 
+def print_table(rows, headers):
+    columns = [["" if value is None else str(value) for value in column] for column in zip(*rows)]
+    widths = [
+        max(len(header), *(len(part) for cell in column for part in cell.split("\n")))
+        for header, column in zip(headers, columns)
+    ]
+    right = [
+        all(isinstance(value, numbers.Number) and not isinstance(value, bool)
+            for value in column if value is not None)
+        for column in zip(*rows)
+    ]
+
+    def line(cells):
+        return "| " + " | ".join(
+            cell.rjust(width) if align_right else cell.ljust(width)
+            for cell, width, align_right in zip(cells, widths, right)
+        ) + " |\n"
+
+    border = "+" + "+".join("-" * (width + 2) for width in widths) + "+\n"
+    write = sys.stdout.write
+    write(border)
+    write(line(headers))
+    write("|" + "+".join("-" * (width + 2) for width in widths) + "|\n")
+    for cells in zip(*columns):
+        # Multiline values get one physical line per text line, like psql.
+        parts = [cell.split("\n") for cell in cells]
+        for index in range(max(map(len, parts))):
+            write(line([part[index] if index < len(part) else "" for part in parts]))
+    write(border)
+
 def log_interaction(command, sql, result):
-    with open("query_log.txt", "a") as f:
-        f.write(f"\n[{datetime.now()}]\nCommand: {command}\nSQL: {sql}\nResult: {result}\n")
+    log_queue.put(f"[{datetime.now().isoformat()}]\t{command}\t{sql!r}\t{result!r}\n")
 
-def execute_sql(conn, sql, operation, conversation_context):
+def execute_sql(conn, sql, info, conversation_context):
+    operation = info.operation
     try:
         if operation == "select":
             sql = auto_lowercase_where(sql)
 
-        with conn.cursor() as cursor:
-            cursor.execute(sql)
-            if operation == "select":
-                rows = cursor.fetchall()
-                headers = [desc[0] for desc in cursor.description]
-                if rows:
-                    table = tabulate(rows, headers, tablefmt="psql")
-                    print("\nResult:\n" + table)
-                    conversation_context["last_table"] = detected_table_name(sql)
-                    conversation_context["last_filters"] = extract_filters(sql)
-                    conversation_context["last_result"] = rows
-                    return "Query executed successfully. Data displayed in table format."
-                else:
+        if operation == "select":
+            query = sql.strip().rstrip(";")
+            limited = not info.has_limit
+            if limited:
+                # The newline keeps a trailing -- comment from swallowing the wrapper.
+                query = f"SELECT * FROM ({query}\n) _subq LIMIT {ROW_LIMIT}"
+
+            with conn.cursor() as cursor:
+                cursor.execute(f"EXPLAIN (FORMAT JSON) {query}")
+                cost = cursor.fetchone()[0][0]["Plan"]["Total Cost"]
+            if cost > MAX_QUERY_COST:
+                return f"This query is too expensive to run (estimated cost {cost:.0f}). Please narrow it down."
+
+            with conn.cursor(name=f"sel_{uuid.uuid4().hex}") as cursor:
+                cursor.execute(query)
+                # One extra row tells us whether there is more to count.
+                rows = cursor.fetchmany(MAX_DISPLAY + 1)
+                if not rows:
                     return "No results found."
+
+                headers = [desc[0] for desc in cursor.description]
+                print("\nResult:")
+                print_table(rows[:MAX_DISPLAY], headers)
+                row_count = len(rows)
+                if row_count > MAX_DISPLAY:
+                    # Count the rest server-side instead of pulling them over the wire.
+                    row_count += conn.execute(
+                        SQL("MOVE FORWARD ALL IN {}").format(Identifier(cursor.name))
+                    ).rowcount
+                    more = "at least " if limited and row_count == ROW_LIMIT else ""
+                    print(f"... {more}{row_count - MAX_DISPLAY} more rows")
+
+            conversation_context["last_table"] = info.table
+            conversation_context["last_filters"] = info.filters
+            conversation_context["last_result"] = {
+                "row_count": row_count,
+                "first_row": rows[0]
+            }
+            return "Query executed successfully. Data displayed in table format."
+
+        # Every row needs its own "(", so skip the full parse unless COPY is possible.
+        bulk = None
+        if operation == "insert" and sql.count("(") > COPY_THRESHOLD + 1:
+            bulk = parse_bulk_insert(sql)
+        with conn.cursor() as cursor:
+            if bulk and len(bulk[2]) > COPY_THRESHOLD:
+                copy_rows(cursor, *bulk)
             else:
-                conn.commit()
-                return f"{operation.capitalize()} executed successfully."
+                cursor.execute(sql)
+        conn.commit()
+        if operation in DDL_OPERATIONS:
+            invalidate_schema(conn.info.dbname)
+        return f"{operation.capitalize()} executed successfully."
     except Exception as e:
         conn.rollback()
         healed_sql = self_heal_sql(sql)
         if healed_sql != sql:
             speak("Trying auto-healed version of query...")
-            return execute_sql(conn, healed_sql, operation, conversation_context)
+            return execute_sql(conn, healed_sql, analyze_sql(healed_sql), conversation_context)
         return f"Error: {e}"
 
+def search_document(text_columns):
+    return SQL("to_tsvector('simple', {})").format(
+        SQL(" || ' ' || ").join(
+            SQL("coalesce({}, '')").format(Identifier(col)) for col in text_columns
+        )
+    )
+
+def ensure_fts_index(conn, table, text_columns, document):
+    key = (conn.info.dbname, table)
+    if key in _fts_indexed:
+        return
+    # The column list is part of the name so a changed document gets a new index.
+    digest = hashlib.md5(",".join(text_columns).encode()).hexdigest()[:8]
+    try:
+        conn.execute(
+            SQL("CREATE INDEX IF NOT EXISTS {} ON {} USING GIN ({})").format(
+                Identifier(f"idx_{table[:40]}_fts_{digest}"), Identifier(table), document
+            )
+        )
+        conn.commit()
+    except psycopg.Error:
+        conn.rollback()
+    _fts_indexed.add(key)
+
 def fallback_search(conn, user_input, last_table):
     if not last_table:
         speak("No previous table context available for fallback search.")
@@ -169,35 +570,46 @@ def fallback_search(conn, user_input, last_table):
 
     try:
         with conn.cursor() as cursor:
-            cursor.execute("""
-                SELECT table_name FROM information_schema.tables 
-                WHERE table_schema = 'public' AND table_name = %s
-            """, (last_table,))
-            if cursor.fetchone() is None:
+            columns = get_table_columns(conn, last_table)
+            if columns is None:
                 speak(f"Table {last_table} not found in the database.")
                 return
 
-            cursor.execute("""
-                SELECT column_name FROM information_schema.columns
-                WHERE table_name = %s AND data_type IN ('character varying', 'text')
-            """, (last_table,))
-            text_columns = [row[0] for row in cursor.fetchall()]
-
+            text_columns = [column for column, dtype in columns if dtype in TEXT_TYPES]
             if not text_columns:
                 speak(f"No text columns found to search in {last_table}.")
                 return
 
-            conditions = " OR ".join([f"{col} ILIKE %s" for col in text_columns])
-            query = f"SELECT * FROM {last_table} WHERE {conditions}"
-            params = tuple([f"%{user_input}%"] * len(text_columns))
+            words = [
+                word for word in _WORD.findall(user_input.lower())
+                if word not in SEARCH_STOPWORDS and word != last_table
+            ]
+            terms = " | ".join(words)
+            if not terms:
+                speak(f"No similar data found in {last_table}.")
+                return
 
-            cursor.execute(query, params)
+            document = search_document(text_columns)
+            ensure_fts_index(conn, last_table, text_columns, document)
+            query = SQL(
+                "SELECT {columns} FROM {table} WHERE {document} @@ to_tsquery('simple', %(terms)s) "
+                "ORDER BY ts_rank({document}, to_tsquery('simple', %(terms)s)) DESC LIMIT {limit}"
+            ).format(
+                columns=SQL(", ").join(Identifier(column) for column, _ in columns),
+                table=Identifier(last_table),
+                document=document,
+                limit=MAX_DISPLAY
+            )
+
+            # Prepared on first use; the explicit column list means a schema
+            # change produces a new statement instead of reusing a stale plan.
+            cursor.execute(query, {"terms": terms}, prepare=True)
             rows = cursor.fetchall()
             headers = [desc[0] for desc in cursor.description]
 
             if rows:
-                table = tabulate(rows, headers, tablefmt="psql")
-                print("\nFallback Result:\n" + table)
+                print("\nFallback Result:")
+                print_table(rows, headers)
                 speak(f"Showing similar results from {last_table}.")
             else:
                 speak(f"No similar data found in {last_table}.")
@@ -206,17 +618,8 @@ def fallback_search(conn, user_input, last_table):
 
 def create_database(db_name):
     try:
-        conn = psycopg2.connect(
-            host=DB_CONFIG["host"],
-            port=DB_CONFIG["port"],
-            user=DB_CONFIG["user"],
-            password=DB_CONFIG["password"],
-            database="template1"
-        )
-        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-        with conn.cursor() as cursor:
-            cursor.execute(f"CREATE DATABASE {db_name};")
-        conn.close()
+        with admin_pool.connection() as conn:
+            conn.execute(SQL("CREATE DATABASE {}").format(Identifier(db_name)))
         return True
     except Exception as e:
         speak(f"Error creating database: {e}")
@@ -224,31 +627,32 @@ def create_database(db_name):
 
 def drop_database(db_name):
     try:
-        conn = psycopg2.connect(
-            host=DB_CONFIG["host"],
-            port=DB_CONFIG["port"],
-            user=DB_CONFIG["user"],
-            password=DB_CONFIG["password"],
-            database="template1"
-        )
-        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-        with conn.cursor() as cursor:
-            cursor.execute(f"DROP DATABASE IF EXISTS {db_name};")
-        conn.close()
+        with admin_pool.connection() as conn:
+            conn.execute(SQL("DROP DATABASE IF EXISTS {}").format(Identifier(db_name)))
+        invalidate_schema(db_name)
         return True
     except Exception as e:
         speak(f"Error dropping database: {e}")
         return False
 
+def spoken_db_name(command, phrase):
+    return command.split(phrase)[-1].strip().replace(" ", "_")
+
 def main():
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
+        pool = open_pool(DB_CONFIG["dbname"])
     except Exception as e:
         speak(f"Database connection failed: {e}")
+        tts_queue.join()
         return
 
+    # The greeting plays while the rest of start-up runs; calibration waits for it.
     speak("Voice SQL Assistant is now active.")
-    schema_info = get_schema_info(conn)
+    admin_pool.open()
+    threading.Thread(target=warm_up_openai, daemon=True).start()
+    with pool.connection() as conn:
+        schema_info = get_schema_info(conn)
+    calibrate_microphone()
 
     conversation_context = {
         "last_table": None,
@@ -262,16 +666,17 @@ def main():
             speak("Goodbye!")
             break
 
-        for pronoun in ["he", "she", "they", "it", "that"]:
-            for col, val in conversation_context["last_filters"].items():
-                command = re.sub(rf"\b{pronoun}\b", val, command, flags=re.IGNORECASE)
+        command = resolve_pronouns(command, conversation_context["last_filters"])
 
         if "use database" in command:
-            db = command.split("use database")[-1].strip().replace(" ", "_")
-            DB_CONFIG["database"] = db
+            db = spoken_db_name(command, "use database")
             try:
-                conn = psycopg2.connect(**DB_CONFIG)
-                schema_info = get_schema_info(conn)
+                new_pool = open_pool(db)
+                pool.close()
+                pool = new_pool
+                DB_CONFIG["dbname"] = db
+                with pool.connection() as conn:
+                    schema_info = get_schema_info(conn)
                 speak(f"Switched to database {db}")
             except Exception as e:
                 speak(f"Could not connect to database {db}: {e}")
@@ -283,7 +688,8 @@ def main():
             continue
 
         print(f"\nGenerated SQL:\n{sql}")
-        op = detect_operation(sql)
+        info = analyze_sql(sql)
+        op = info.operation
 
         if op in ["drop", "delete", "drop_db", "truncate", "update"]:
             speak("This action will modify or delete data. Say YES to confirm.")
@@ -293,26 +699,35 @@ def main():
                 continue
 
         if op == "create_db":
-            db_name = command.split("create database")[-1].strip()
+            db_name = spoken_db_name(command, "create database")
             if create_database(db_name):
                 speak(f"Database {db_name} created.")
             continue
 
         if op == "drop_db":
-            db_name = command.split("drop database")[-1].strip()
+            db_name = spoken_db_name(command, "drop database")
             if drop_database(db_name):
                 speak(f"Database {db_name} dropped.")
             continue
 
-        result = execute_sql(conn, sql, op, conversation_context)
-        log_interaction(command, sql, result)
+        with pool.connection() as conn:
+            result = execute_sql(conn, sql, info, conversation_context)
 
-        if "no results found" in result.lower() and op == "select":
-            fallback_search(conn, command, conversation_context["last_table"])
-        else:
-            speak(result)
+            if "no results found" in result.lower() and op == "select":
+                fallback_search(conn, command, conversation_context["last_table"])
+            else:
+                speak(result)
+
+            # Runs while the reply above is still being spoken.
+            log_interaction(command, sql, result)
+            if op in DDL_OPERATIONS:
+                schema_info = get_schema_info(conn)
 
-    conn.close()
+    pool.close()
+    admin_pool.close()
+    log_queue.join()
+    tts_queue.join()
+    LOG_FH.close()
 
 if __name__ == "__main__":
     main()